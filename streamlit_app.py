@@ -1,32 +1,30 @@
-from typing import Union
+from typing import Union, TYPE_CHECKING
 import streamlit as st
 import os
 import json
+import orjson
 import shutil
 import time
-import glob
 import threading
+import importlib
+import heapq
+import logging
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from random import choice
-from string import ascii_letters
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import secrets
 from datetime import datetime as dt, timedelta as td
 
 import extra_streamlit_components as stx
-import skgstat as skg
-import gstools as gs
-from google.cloud import firestore
-from google.oauth2.credentials import Credentials
 
 
-# import all chapters
-from skgstat_uncertainty.api import API
-from skgstat_uncertainty.components import data_selector
-from skgstat_uncertainty.chapters.data_manage import main_app as data_manager, sample_dense_data
-from skgstat_uncertainty.chapters.variogram import main_app as vario_app
-from skgstat_uncertainty.chapters.model_fitting import main_app as fit_app
-from skgstat_uncertainty.chapters.kriging import main_app as kriging_app
-from skgstat_uncertainty.chapters.model_simulation import main_app as simulation_app
-from skgstat_uncertainty.chapters.model_compare import main_app as compare_app
+# skgstat_uncertainty loads the geostatistics stack - it is imported on first use
+if TYPE_CHECKING:
+    from skgstat_uncertainty.api import API
+
+
+logger = logging.getLogger(__name__)
 
 
 # define the different chapters
@@ -43,6 +41,46 @@ ALL_CHAPTERS = {
 }
 
 
+@st.cache_resource(show_spinner=False)
+def _chapters(can_upload: bool) -> tuple:
+    # chapters and their option list with or without upload permission - shared read-only across reruns
+    hidden = 'sample' if can_upload else 'data'
+    chapters = {k: v for k, v in ALL_CHAPTERS.items() if k != hidden}
+    return chapters, list(chapters.keys())
+
+
+# static paths relative to this application
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_DATA_DIR = os.path.join(_HERE, 'data')
+_BASE_DATA_JSON = os.path.join(_HERE, 'BASE_DATA.json')
+_FIREBASE_JSON = os.path.join(_HERE, 'config', '.firebase.json')
+
+# CookieManager.set and delete only mount a component, the browser applies the change once its JS ran.
+# reset() reruns right away and could drop the component before that, thus wait before a rerun (in seconds)
+COOKIE_WRITE_WAIT = 0.5
+COOKIE_DELETE_WAIT = 1.0
+
+# anonymous databases are removed after 14 days (in seconds)
+ANONYMOUS_DB_MAX_AGE = 14 * 86400
+
+# the MAX_DB_BYTES size budget only evicts databases unmodified for one cleanup interval (in seconds)
+EVICTION_MIN_AGE = 3600
+
+
+@st.cache_data(show_spinner=False)
+def _base_data() -> dict:
+    # load the BASE_DATA once per process
+    with open(_BASE_DATA_JSON, 'r') as f:
+        return json.load(f)
+
+
+@st.cache_data(show_spinner=False)
+def _firebase_conf() -> dict:
+    # load the firebase config once per process
+    with open(_FIREBASE_JSON, 'r') as f:
+        return json.load(f)
+
+
 CONSENT_TEXT = """This application stores an randomly generated string into your browsers cookies.
 This enables the application to identify your browser and load the correct data from the database.
 Without this cookie, the application does not work, and you need to leave this website.
@@ -85,14 +123,11 @@ ATTRIBUTIONS = [
 
 def navigation(container=st) -> str:
     can_upload = st.session_state.get('skg_opts', {}).get('can_upload', False)
-    if can_upload:
-        CHAPTERS = {k: v for k, v in ALL_CHAPTERS.items() if k != 'sample'}
-    else:
-        CHAPTERS = {k: v for k, v in ALL_CHAPTERS.items() if k != 'data'}
+    CHAPTERS, KEYS = _chapters(can_upload)
 
     page = container.selectbox(
         'Navigation',
-        options=list(CHAPTERS.keys()),
+        options=KEYS,
         format_func=lambda k: CHAPTERS.get(k)
     )
     return page
@@ -148,19 +183,20 @@ def index() -> None:
                     st.warning('Deleting non-file db connections not supported yet.')
 
             # do the actual cookie deletion
-            mng = stx.CookieManager()
-            mng.delete(cookie='skg_opts', key='cookie_delete')
+            _mng().delete(cookie='skg_opts', key='cookie_delete')
             del st.session_state['skg_opts']
             
-
+            # let the browser delete the cookie
             with st.spinner('Deleting cookie...'):
-                time.sleep(1.0)
+                time.sleep(COOKIE_DELETE_WAIT)
                 reset()
 
 
-def code_reference() -> None:
-    st.title('Code reference')
-    st.markdown('Below, you can load the docstring for the relevant functions taken from SciKit-GStat and GSTools')
+@st.cache_resource(show_spinner=False)
+def _code_reference_funcs():
+    # the geostatistics stack is only needed for this page
+    import skgstat as skg
+    import gstools as gs
 
     funcs = {
         skg.Variogram.__init__: 'Variogram [SciKit-GStat]',
@@ -182,7 +218,15 @@ def code_reference() -> None:
         skg.binning.kmeans: 'KMean binning [SciKit-GStat]',
     }
 
-    func_name = st.selectbox('Function name', options=list(funcs.keys()), format_func=lambda k: funcs.get(k))
+    return funcs, list(funcs.keys())
+
+
+def code_reference() -> None:
+    st.title('Code reference')
+    st.markdown('Below, you can load the docstring for the relevant functions taken from SciKit-GStat and GSTools')
+
+    funcs, func_keys = _code_reference_funcs()
+    func_name = st.selectbox('Function name', options=func_keys, format_func=lambda k: funcs.get(k))
 
     st.markdown(f'## Code documentation')
     help_expander = st.expander('__doc__', expanded=True)
@@ -190,20 +234,39 @@ def code_reference() -> None:
 
 
 def reset():
+    # close the database session before dropping it with the session state
+    cached = st.session_state.get('skg_api')
+    if cached is not None:
+        _close_api(cached[1])
+
     st.session_state.clear()
     st.experimental_rerun()
     # raise st.script_runner.RerunException(st.script_request_queue.RerunData(None))
 
 
+# ioctl request code of Linux FICLONE (copy-on-write file clone)
+_FICLONE = 0x40049409
+
+
+def _clone(src: str, dst: str) -> None:
+    # try a copy-on-write reflink first (btrfs, xfs), fall back to a regular copy
+    try:
+        import fcntl
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+
+    shutil.copyfile(src, dst)
+
+
 def coookie_consent(mng: stx.CookieManager):
     st.title('Consent')
-    user_id = ''.join(choice(ascii_letters) for _ in range(24))
+    user_id = secrets.token_urlsafe(18)
     st.markdown(CONSENT_TEXT.format(user_id=user_id))
 
-    # load the BASE_DATA
-    with open(os.path.join(os.path.dirname(__file__), 'BASE_DATA.json'), 'r') as f:
-        BASE_DATA = json.load(f)
-     
+    BASE_DATA = _base_data()
     base_data = st.selectbox('DATABASE', options=list(BASE_DATA.keys()), format_func=lambda k: BASE_DATA.get(k))
 
     l, c, r, _ = st.columns((1,1,1,7))
@@ -212,10 +275,10 @@ def coookie_consent(mng: stx.CookieManager):
     login(cookie_manager=mng, key='consent_login', base_data=base_data, container=r)
     
     if accept or decline:
-        path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data'))
+        path = _DATA_DIR
         
         if accept:
-            shutil.copy(os.path.join(path, f'{base_data}.db'), os.path.join(path, f'a_{user_id}.db'))
+            _clone(os.path.join(path, f'{base_data}.db'), os.path.join(path, f'a_{user_id}.db'))
         
         # set info dict
         info = {
@@ -227,20 +290,30 @@ def coookie_consent(mng: stx.CookieManager):
         }
 
         # mng = stx.CookieManager()
-        mng.set('skg_opts', json.dumps(info), expires_at=dt.now() + td(days=14 if accept else 1))
+        mng.set('skg_opts', orjson.dumps(info).decode(), expires_at=dt.now() + td(days=14 if accept else 1))
         st.session_state.skg_opts = info
+
+        # let the browser write the cookie
         with st.spinner('saving'):
-            time.sleep(0.5)
+            time.sleep(COOKIE_WRITE_WAIT)
 
         reset()
     else:
         st.stop()
 
 
+@st.cache_resource(show_spinner=False)
+def _http_session() -> requests.Session:
+    # keep-alive session shared by all logins of this process
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=Retry(total=2, backoff_factor=0.2)))
+
+    return session
+
+
 def _firebase_login(username: str, password: str, token_only: bool = False):
-    # open config file
-    with open(os.path.join(os.path.dirname(__file__),'config', '.firebase.json'), 'r') as f:
-        CONF = json.load(f)
+    # get the config file
+    CONF = _firebase_conf()
     
     # get the info
     API_KEY = CONF['APIKEY']
@@ -255,7 +328,7 @@ def _firebase_login(username: str, password: str, token_only: bool = False):
     )
 
     # send the request
-    response = requests.post(SIGNIN_URL, data=details)
+    response = _http_session().post(SIGNIN_URL, json=details, timeout=5)
     data = response.json()
 
     if token_only:
@@ -263,12 +336,16 @@ def _firebase_login(username: str, password: str, token_only: bool = False):
 
     # check if successful
     if 'idToken' in data:
+        # the firestore client is only needed on login
+        from google.cloud import firestore
+        from google.oauth2.credentials import Credentials
+
         # create credentials
         cred = Credentials(data['idToken'], refresh_token=data.get('refreshToken'))
 
-        # connect firestore and load user data
+        # connect firestore and load user data - only the info field is used
         db = firestore.Client(credentials=cred, project=PROJECT_ID)
-        ref = db.collection('users').document(data.get('localId')).get()
+        ref = db.collection('users').document(data.get('localId')).get(field_paths=['info'])
 
         return ref.to_dict()
     else:
@@ -292,9 +369,7 @@ def login(cookie_manager: stx.CookieManager, key='', base_data: str = None, cont
                 password = st.text_input('Password')
 
                 if base_data is None:
-                    # load the BASE_DATA
-                    with open(os.path.join(os.path.dirname(__file__), 'BASE_DATA.json'), 'r') as f:
-                        BASE_DATA = json.load(f)
+                    BASE_DATA = _base_data()
                     base_data = st.selectbox('DATABASE', options=list(BASE_DATA.keys()), format_func=lambda k: BASE_DATA.get(k))
 
                 did_submit = st.form_submit_button('SEND')
@@ -308,7 +383,7 @@ def login(cookie_manager: stx.CookieManager, key='', base_data: str = None, cont
                         st.stop()
                     
                     # if not stopped, the authentication was successful
-                    path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data'))
+                    path = _DATA_DIR
                         
                     # handle the login
                     info = {'data_path': path}
@@ -316,13 +391,15 @@ def login(cookie_manager: stx.CookieManager, key='', base_data: str = None, cont
                     
                     # do the saving
                     with st.spinner('saving'):
-                        cookie_manager.set('skg_opts', json.dumps(info), expires_at=dt.now() + td(days=30))    
-                        time.sleep(0.5)
+                        cookie_manager.set('skg_opts', orjson.dumps(info).decode(), expires_at=dt.now() + td(days=30))
+
+                        # let the browser write the cookie
+                        time.sleep(COOKIE_WRITE_WAIT)
 
                         # if sqlite copy base data if necessary
                         if base_data != 'plain' and info.get('db_name', '').endswith('.db'):
                             if not os.path.exists(os.path.join(path, f'u_{username}.db')):
-                                    shutil.copy(os.path.join(path, f'{base_data}.db'), os.path.join(path, f'u_{username}.db'))
+                                    _clone(os.path.join(path, f'{base_data}.db'), os.path.join(path, f'u_{username}.db'))
                         
                         # handle session state
                         st.session_state.skg_opts = info
@@ -339,38 +416,182 @@ def login(cookie_manager: stx.CookieManager, key='', base_data: str = None, cont
                 st.experimental_rerun()
 
 
-def cleanup_files(api: API) -> None:
-    # get all files
-    data_path = api._kwargs.get('data_path', os.path.join(os.path.dirname(__file__), 'data'))
-    files = glob.glob(os.path.join(data_path, 'a_*.db'))
+def _close_api(api: 'API') -> None:
+    # release the database session and the engine created for this API
+    api.session.close()
+    api.session.get_bind().dispose()
+
+
+def get_api(db_name: str = None, data_path: str = None, share: bool = False, can_upload: bool = False, uri: str = None) -> 'API':
+    # build the API options - API switches to the uri, if one is given
+    opts = dict(db_name=db_name, data_path=data_path, share=share, can_upload=can_upload)
+    if uri is not None:
+        opts['uri'] = uri
+    
+    # one API per user session - database sessions are not thread-safe
+    key = tuple(sorted(opts.items()))
+    cached = st.session_state.get('skg_api')
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    
+    # the options changed, close the old database session
+    if cached is not None:
+        _close_api(cached[1])
+    
+    # the API pulls in skgstat, numpy and plotly - only import it once an API is needed
+    from skgstat_uncertainty.api import API
+
+    api = API(**opts)
+    st.session_state.skg_api = (key, api)
+    return api
+
+
+def _anonymous_dbs(data_path: str):
+    # stream the anonymous database files without listing the directory
+    with os.scandir(data_path) as it:
+        for entry in it:
+            if entry.name.startswith('a_') and entry.name.endswith('.db') and entry.is_file():
+                yield entry
+
+
+def _remove(path: str) -> None:
+    # another process might already have removed the file
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_all(paths: list, max_workers: int = 8) -> None:
+    # unlink in parallel, as the syscall latency dominates on network storage
+    if len(paths) == 0:
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as pool:
+        list(pool.map(_remove, paths))
+
+
+def _evict_oldest(data_path: str, excess: int, min_age: float = EVICTION_MIN_AGE) -> None:
+    # keep only the oldest databases needed to free excess bytes - youngest on top
+    heap, size = [], 0
+    newest = time.time() - min_age
+    for entry in _anonymous_dbs(data_path):
+        stat = entry.stat()
+
+        # never evict databases that might still be in use by an open session
+        if stat.st_mtime > newest:
+            continue
+        heapq.heappush(heap, (-stat.st_mtime, stat.st_size, entry.path))
+        size += stat.st_size
+
+        # drop the youngest candidate as long as the others free enough space
+        while heap and size - heap[0][1] >= excess:
+            size -= heapq.heappop(heap)[1]
+    
+    _remove_all([path for _, _, path in heap])
+
+
+def cleanup_files(data_path: str = _DATA_DIR) -> float:
+    # remove anonymous databases older than 14 days
+    cutoff = time.time() - ANONYMOUS_DB_MAX_AGE
+    next_expiry = float('inf')
+    total_bytes = 0
+    expired = []
 
-    # check each file:
-    for file in files:
-        mod_date = dt.fromtimestamp(os.path.getmtime(file))
-        if dt.now() > mod_date + td(days=14):
-            os.remove(file)
+    # check each anonymous database file
+    for entry in _anonymous_dbs(data_path):
+        stat = entry.stat()
+        if stat.st_mtime < cutoff:
+            expired.append(entry.path)
+        else:
+            next_expiry = min(next_expiry, stat.st_mtime + ANONYMOUS_DB_MAX_AGE)
+            total_bytes += stat.st_size
+    _remove_all(expired)
+    
+    # if a size budget is set, remove the least recently used databases - see README
+    max_bytes = int(os.environ.get('MAX_DB_BYTES', 0) or 0)
+    if max_bytes > 0 and total_bytes > max_bytes:
+        _evict_oldest(data_path, total_bytes - max_bytes)
+
+    # mark the cleanup as done - other sessions can skip the scan
+    with open(os.path.join(data_path, '.last_cleanup'), 'w'):
+        pass
+    
+    # return the time the next remaining database expires
+    return next_expiry
+
+
+def _cleanup_loop(data_path: str, interval: float = 3600) -> None:
+    last_dir_mtime, next_expiry = None, 0.0
+    last_error = None
+    while True:
+        try:
+            # the directory mtime only changes if databases were added or removed
+            dir_mtime = os.stat(data_path).st_mtime
+            unchanged = dir_mtime == last_dir_mtime and time.time() < next_expiry
+
+            # skip the scan if another process did run it recently - the margin keeps coarse
+            # or skewed mtimes (NFS) from skipping this worker's own hourly run
+            sentinel = os.path.join(data_path, '.last_cleanup')
+            recent = os.path.exists(sentinel) and time.time() - os.path.getmtime(sentinel) < interval / 2
+
+            if not unchanged and not recent:
+                next_expiry = cleanup_files(data_path)
+                last_dir_mtime = dir_mtime
+            last_error = None
+        except Exception as e:
+            # the worker is started only once per process, it must not die - try again on the next run
+            if repr(e) != last_error:
+                logger.exception(f'Cleanup of {data_path} failed, retrying in {interval} seconds.')
+            last_error = repr(e)
+        time.sleep(interval)
+
+
+@st.cache_resource(show_spinner=False)
+def start_cleanup_worker(data_path: str) -> threading.Thread:
+    # cached resources are shared by all sessions, thus only one worker is started
+    thread = threading.Thread(target=_cleanup_loop, args=(data_path,), daemon=True)
+    thread.start()
+
+    return thread
+
+
+def _mng() -> stx.CookieManager:
+    # one cookie manager per session - avoids re-mounting the component
+    if 'cookie_mgr' not in st.session_state:
+        st.session_state.cookie_mgr = stx.CookieManager()
+    return st.session_state.cookie_mgr
+
+
+def _parse_opts(raw) -> Union[dict, None]:
+    # the cookie is stored as JSON string - parse only once
+    if isinstance(raw, str):
+        try:
+            raw = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            return None
+    
+    # the browser controls the cookie - only accept a dict of options
+    return raw if isinstance(raw, dict) else None
 
 
-def handle_session() -> str:
+def handle_session(mng: stx.CookieManager) -> str:
     opts = st.session_state.get('skg_opts')
     
     # no opts set, so load cookie consent
     if opts is None:
-        mng = stx.CookieManager()
-        time.sleep(0.5)
         all_cookies = mng.get_all()
         if all_cookies is None:
             all_cookies = {}
         
         # get the opts
-        if 'skg_opts' in all_cookies:
-            st.session_state.skg_opts = all_cookies['skg_opts']
-            return all_cookies['skg_opts']
+        opts = _parse_opts(all_cookies.get('skg_opts'))
+        if opts is not None:
+            st.session_state.skg_opts = opts
+            return opts
         else:
-            # handle consent
+            # handle consent - this also replaces a malformed cookie
             coookie_consent(mng)
     elif not opts.get('did_login', False):
-        mng = stx.CookieManager()
         login(mng, key='session_handler', container=st.sidebar)
         return opts
     else:
@@ -378,6 +599,41 @@ def handle_session() -> str:
         return opts    
     
 
+def sample_app(api: 'API') -> None:
+    from skgstat_uncertainty.components import data_selector
+    from skgstat_uncertainty.chapters.data_manage import sample_dense_data
+
+    dataset = data_selector(api=api, stop_with='data', data_type='field')
+    sample_dense_data(dataset=dataset, api=api)
+
+
+# map each chapter to its page handler
+PAGES = {
+    'home': lambda api: index(),
+    'sample': sample_app,
+    'code_ref': lambda api: code_reference(),
+}
+
+# chapter modules providing a main_app page handler
+CHAPTER_MODULES = {
+    'data': 'skgstat_uncertainty.chapters.data_manage',
+    'variogram': 'skgstat_uncertainty.chapters.variogram',
+    'model': 'skgstat_uncertainty.chapters.model_fitting',
+    'kriging': 'skgstat_uncertainty.chapters.kriging',
+    'simulation': 'skgstat_uncertainty.chapters.model_simulation',
+    'compare': 'skgstat_uncertainty.chapters.model_compare',
+}
+
+
+def get_page_handler(page_name: str):
+    if page_name in PAGES:
+        return PAGES[page_name]
+    
+    # import the chapter only when it is requested - sys.modules caches it
+    if page_name in CHAPTER_MODULES:
+        return importlib.import_module(CHAPTER_MODULES[page_name]).main_app
+
+
 def main_app(**kwargs):
     # some page settings
     st.set_page_config('Uncertainty by hydrocode', layout=kwargs.get('layout', 'wide'))
@@ -385,47 +641,29 @@ def main_app(**kwargs):
     # add the logo
     st.sidebar.image("https://firebasestorage.googleapis.com/v0/b/hydrocode-website.appspot.com/o/public%2Fhydrocode_brand.png?alt=media")
 
+    # get the cookie manager of this session
+    mng = _mng()
+
     # get the session data to identify correct database
-    opts = handle_session()
+    opts = handle_session(mng)
 
     # fix paths
-    data_path = kwargs.get('data_path', os.path.join(os.path.dirname(__file__), 'data'))
+    data_path = kwargs.get('data_path', _DATA_DIR)
     opts.update({'data_path': data_path})
     
     # add navigation
     page_name = navigation(container=st.sidebar)
 
-    # create an API instance
-    api = API(**opts)
+    # get the API instance - kept across reruns of this session
+    api = get_api(**{k: v for k, v in opts.items() if k in ('db_name', 'data_path', 'share', 'can_upload', 'uri')})
 
-    # check if cleanup already ran in this session
-    did_cleanup = st.session_state.get('did_cleanup', False)
-    if not did_cleanup:
-        # create a thread for cleanup
-        thread = threading.Thread(target=lambda: cleanup_files(api=api))
-        thread.start()
-        st.session_state.did_cleanup = True
+    # make sure the process-wide cleanup worker is running
+    start_cleanup_worker(data_path)
 
     try:
-        if page_name == 'home':
-            index()
-        elif page_name == 'data':
-            data_manager(api=api)
-        elif page_name == 'sample':
-            dataset = data_selector(api=api, stop_with='data', data_type='field')
-            sample_dense_data(dataset=dataset, api=api)
-        elif page_name == 'variogram':
-            vario_app(api=api)
-        elif page_name == 'model':
-            fit_app(api=api)
-        elif page_name == 'kriging':
-            kriging_app(api=api)
-        elif page_name == 'simulation':
-            simulation_app(api=api)
-        elif page_name == 'compare':
-            compare_app(api=api)
-        elif page_name == 'code_ref':
-            code_reference()
+        handler = get_page_handler(page_name)
+        if handler is not None:
+            handler(api=api)
     except Exception as e:
         error_exapnder = st.expander('DEBUG', expanded=True)
         error_exapnder.title('Unallowed action')